@@ -1,6 +1,5 @@
 from collections import defaultdict
 import json
-import re
 import time
 from urllib.parse import urlparse
 import uuid
@@ -35,8 +34,6 @@ from ichnaea.models.content import encode_datamap_grid
 from ichnaea import util
 
 
-WHITESPACE = re.compile(r"\s", flags=re.UNICODE)
-
 METRICS = markus.get_metrics()
 
 
@@ -69,13 +66,21 @@ class IncomingQueue(object):
         with self.task.db_session(commit=False) as session:
             export_configs = ExportConfig.all(session)
 
+        # Merge the items for each export queue, so every queue gets a
+        # single batched push, even if many groups share the same queue.
+        queued = {}
+        for (api_key, source), items in grouped.items():
+            for config in export_configs:
+                if config.allowed(api_key, source):
+                    queue_key = config.queue_key(api_key, source)
+                    if queue_key not in queued:
+                        queued[queue_key] = (config, [])
+                    queued[queue_key][1].extend(items)
+
         with self.task.redis_pipeline() as pipe:
-            for (api_key, source), items in grouped.items():
-                for config in export_configs:
-                    if config.allowed(api_key, source):
-                        queue_key = config.queue_key(api_key, source)
-                        queue = config.queue(queue_key, redis_client)
-                        queue.enqueue(items, pipe=pipe)
+            for queue_key, (config, items) in queued.items():
+                queue = config.queue(queue_key, redis_client)
+                queue.enqueue(items, pipe=pipe)
 
         for config in export_configs:
             # Check all queues if they now contain enough data or
@@ -286,24 +291,33 @@ class InternalTransform(object):
         ("signalStrength", "signal"),
     ]
 
-    def _map_dict(self, item_source, field_map):
-        value = {}
-        for spec in field_map:
-            if isinstance(spec, tuple):
-                source, target = spec
-            else:
-                source = spec
-                target = spec
-            source_value = item_source.get(source)
-            if source_value is not None:
-                value[target] = source_value
-        return value
+    def __init__(self):
+        # index the field maps by source name
+        self._position_fields = self._field_index(self.position_map)
+        self._blue_fields = self._field_index(self.blue_map)
+        self._cell_fields = self._field_index(self.cell_map)
+        self._wifi_fields = self._field_index(self.wifi_map)
+
+    @staticmethod
+    def _field_index(field_map):
+        return dict(
+            spec if isinstance(spec, tuple) else (spec, spec) for spec in field_map
+        )
+
+    def _map_dict(self, item_source, fields):
+        # only look at the fields present in the source, as most
+        # of the mapped fields tend to be missing
+        return {
+            fields[source]: value
+            for source, value in item_source.items()
+            if source in fields and value is not None
+        }
 
-    def _parse_dict(self, item, report, key_map, field_map):
+    def _parse_dict(self, item, report, key_map, fields):
         value = {}
         item_source = item.get(key_map[0])
         if item_source:
-            value = self._map_dict(item_source, field_map)
+            value = self._map_dict(item_source, fields)
         if value:
             if key_map[1] is None:
                 report.update(value)
@@ -311,11 +325,14 @@ class InternalTransform(object):
                 report[key_map[1]] = value
         return value
 
-    def _parse_list(self, item, report, key_map, field_map):
+    def _parse_list(self, item, report, key_map, fields, gps_age=0):
         values = []
         for value_item in item.get(key_map[0], ()):
-            value = self._map_dict(value_item, field_map)
+            value = self._map_dict(value_item, fields)
             if value:
+                if gps_age:
+                    # Normalize age fields to be relative to GPS time
+                    value["age"] = value.get("age", 0) - gps_age
                 values.append(value)
         if values:
             report[key_map[1]] = values
@@ -323,11 +340,7 @@ class InternalTransform(object):
 
     def __call__(self, item):
         report = {}
-        self._parse_dict(item, report, self.position_id, self.position_map)
-
-        blues = self._parse_list(item, report, self.blue_id, self.blue_map)
-        cells = self._parse_list(item, report, self.cell_id, self.cell_map)
-        wifis = self._parse_list(item, report, self.wifi_id, self.wifi_map)
+        self._parse_dict(item, report, self.position_id, self._position_fields)
 
         position = item.get("position") or {}
         gps_age = position.get("age", 0)
@@ -336,11 +349,9 @@ class InternalTransform(object):
             # turn timestamp into GPS timestamp
             report["timestamp"] = timestamp - gps_age
 
-        if gps_age:
-            # Normalize age fields to be relative to GPS time
-            for type_ in ("blue", "cell", "wifi"):
-                for record in report.get(type_, ()):
-                    record["age"] = record.get("age", 0) - gps_age
+        blues = self._parse_list(item, report, self.blue_id, self._blue_fields, gps_age)
+        cells = self._parse_list(item, report, self.cell_id, self._cell_fields, gps_age)
+        wifis = self._parse_list(item, report, self.wifi_id, self._wifi_fields, gps_age)
 
         if blues or cells or wifis:
             return report
@@ -350,87 +361,99 @@ class InternalTransform(object):
 class InternalExporter(ReportExporter):
 
     _retriable = (IOError, redis.exceptions.RedisError, sqlalchemy.exc.InternalError)
+    _observation_types = (
+        ("blue", BlueReport, BlueObservation),
+        ("cell", CellReport, CellObservation),
+        ("wifi", WifiReport, WifiObservation),
+    )
     transform = InternalTransform()
 
     def send(self, queue_items):
-        api_keys = set()
         api_keys_known = set()
         metrics = {}
+        map_enabled = _map_content_enabled()
+        grids = set()
+        datamap_shards = {shard_id: set() for shard_id in DataMap.shards()}
+        # one bucket per shard queue
+        queued_obs = {
+            "blue": {shard_id: [] for shard_id in BlueShard.shards()},
+            "cell": {shard_id: [] for shard_id in CellShard.shards()},
+            "wifi": {shard_id: [] for shard_id in WifiShard.shards()},
+        }
 
-        items = []
-        for item in queue_items:
-            # preprocess items and extract set of API keys
-            item["report"] = self.transform(item["report"])
-            if item["report"]:
-                items.append(item)
-                api_keys.add(item["api_key"])
-
-        for api_key in api_keys:
-            metrics[api_key] = {}
-            for type_ in ("report", "blue", "cell", "wifi"):
-                for action in ("drop", "upload"):
-                    metrics[api_key]["%s_%s" % (type_, action)] = 0
-
-        with self.task.db_session(commit=False) as session:
-            # limit database session to get API keys
-            keys = [key for key in api_keys if key]
-            if keys:
-                columns = ApiKey.__table__.c
-                rows = session.execute(
-                    select([columns.valid_key]).where(columns.valid_key.in_(keys))
-                ).fetchall()
-
-                for row in rows:
-                    api_keys_known.add(row.valid_key)
+        transform = self.transform
+        process_report = self.process_report
 
-        positions = []
-        observations = {"blue": [], "cell": [], "wifi": []}
+        for item in queue_items:
+            # leave the queued item unchanged, so a retried send starts
+            # over with the original data
+            report = transform(item["report"])
+            if not report:
+                continue
 
-        for item in items:
             api_key = item["api_key"]
-            report = item["report"]
+            key_metrics = metrics.get(api_key)
+            if key_metrics is None:
+                key_metrics = metrics[api_key] = {
+                    "%s_%s" % (type_, action): 0
+                    for type_ in ("report", "blue", "cell", "wifi")
+                    for action in ("drop", "upload")
+                }
 
-            obs, malformed_obs = self.process_report(report)
+            obs, malformed_obs = process_report(report)
 
             any_data = False
             for name in ("blue", "cell", "wifi"):
                 if obs.get(name):
-                    observations[name].extend(obs[name])
-                    metrics[api_key][name + "_upload"] += len(obs[name])
+                    # group by sharded queue
+                    sharded = queued_obs[name]
+                    for ob in obs[name]:
+                        sharded[ob.shard_id].append(ob.to_json())
+                    key_metrics[name + "_upload"] += len(obs[name])
                     any_data = True
-                metrics[api_key][name + "_drop"] += malformed_obs.get(name, 0)
+                key_metrics[name + "_drop"] += malformed_obs.get(name, 0)
 
-            metrics[api_key]["report_upload"] += 1
+            key_metrics["report_upload"] += 1
             if any_data:
-                positions.append((report["lat"], report["lon"]))
+                if map_enabled:
+                    # scale, shard and encode each distinct grid in a single pass
+                    grid = DataMap.scale(report["lat"], report["lon"])
+                    if grid not in grids:
+                        grids.add(grid)
+                        shard_id = DataMap.shard_id(*grid)
+                        datamap_shards[shard_id].add(encode_datamap_grid(*grid))
             else:
-                metrics[api_key]["report_drop"] += 1
+                key_metrics["report_drop"] += 1
+
+        keys = [key for key in metrics if key]
+        if keys:
+            # look up all API keys in one query, limiting the database
+            # session to just that
+            columns = ApiKey.__table__.c
+            with self.task.db_session(commit=False) as session:
+                rows = session.execute(
+                    select([columns.valid_key]).where(columns.valid_key.in_(keys))
+                ).fetchall()
+
+            for row in rows:
+                api_keys_known.add(row.valid_key)
 
         with self.task.redis_pipeline() as pipe:
-            self.queue_observations(pipe, observations)
-            if _map_content_enabled and positions:
-                self.process_datamap(pipe, positions)
+            self.queue_observations(pipe, queued_obs)
+            if map_enabled and grids:
+                self.process_datamap(pipe, datamap_shards)
 
         self.emit_metrics(api_keys_known, metrics)
 
-    def queue_observations(self, pipe, observations):
-        for datatype, shard_model, shard_key, queue_prefix in (
-            ("blue", BlueShard, "mac", "update_blue_"),
-            ("cell", CellShard, "cellid", "update_cell_"),
-            ("wifi", WifiShard, "mac", "update_wifi_"),
-        ):
-
-            queued_obs = defaultdict(list)
-            for obs in observations[datatype]:
-                # group by sharded queue
-                shard_id = shard_model.shard_id(getattr(obs, shard_key))
-                queue_id = queue_prefix + shard_id
-                queued_obs[queue_id].append(obs.to_json())
-
-            for queue_id, values in queued_obs.items():
-                # enqueue values for each queue
-                queue = self.task.app.data_queues[queue_id]
-                queue.enqueue(values, pipe=pipe)
+    def queue_observations(self, pipe, queued_obs):
+        data_queues = self.task.app.data_queues
+        for datatype, sharded in queued_obs.items():
+            queue_prefix = "update_%s_" % datatype
+            for shard_id, values in sharded.items():
+                if values:
+                    # enqueue values for each queue
+                    queue = data_queues[queue_prefix + shard_id]
+                    queue.enqueue(values, pipe=pipe)
 
     def emit_metrics(self, api_keys_known, metrics):
         for api_key, key_metrics in metrics.items():
@@ -458,15 +481,10 @@ class InternalExporter(ReportExporter):
             return ({}, {})
 
         malformed = {}
-        observations = {}
-        for name, report_cls, obs_cls in (
-            ("blue", BlueReport, BlueObservation),
-            ("cell", CellReport, CellObservation),
-            ("wifi", WifiReport, WifiObservation),
-        ):
-
+        obs = {}
+        for name, report_cls, obs_cls in self._observation_types:
             malformed[name] = 0
-            observations[name] = {}
+            observations = {}
 
             if data.get(name):
                 for item in data[name]:
@@ -481,29 +499,17 @@ class InternalExporter(ReportExporter):
                     item_key = item_obs.unique_key
 
                     # if we have better data for the same key, ignore
-                    existing = observations[name].get(item_key)
+                    existing = observations.get(item_key)
                     if existing is not None and existing.better(item_obs):
                         continue
 
-                    observations[name][item_key] = item_obs
+                    observations[item_key] = item_obs
 
-        obs = {
-            "blue": observations["blue"].values(),
-            "cell": observations["cell"].values(),
-            "wifi": observations["wifi"].values(),
-        }
+            obs[name] = observations.values()
         return (obs, malformed)
 
-    def process_datamap(self, pipe, positions):
-        grids = set()
-        for lat, lon in positions:
-            if lat is not None and lon is not None:
-                grids.add(DataMap.scale(lat, lon))
-
-        shards = defaultdict(set)
-        for lat, lon in grids:
-            shards[DataMap.shard_id(lat, lon)].add(encode_datamap_grid(lat, lon))
-
+    def process_datamap(self, pipe, shards):
         for shard_id, values in shards.items():
-            queue = self.task.app.data_queues["update_datamap_" + shard_id]
-            queue.enqueue(list(values), pipe=pipe)
+            if values:
+                queue = self.task.app.data_queues["update_datamap_" + shard_id]
+                queue.enqueue(list(values), pipe=pipe)
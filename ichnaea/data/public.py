@@ -6,7 +6,7 @@ import os
 
 import boto3
 import colander
-from more_itertools import peekable
+from more_itertools import chunked, peekable
 from zoneinfo import ZoneInfo
 from sqlalchemy.sql import text
 from sqlalchemy.orm import load_only
@@ -109,37 +109,15 @@ class InvalidCSV(ValueError):
     pass
 
 
-def read_stations_from_csv(session, file_handle, redis_client, cellarea_queue):
+def _parse_station_rows(csv_content):
     """
-    Read stations from a public cell export CSV.
+    Parse and validate the station rows of a public cell export CSV.
 
-    :arg session: a database session
-    :arg file_handle: an open file handle for the CSV data
-    :arg redis_client: a Redis client
-    :arg cellarea_queue: the DataQueue for updating cellarea IDs
+    Yields (data, shard) pairs, with shard being an unsaved CellShard.
     """
-    # Avoid circular imports
-    from ichnaea.data.tasks import update_cellarea, update_statregion
-
-    csv_content = peekable(reader(file_handle))
     # UMTS was the original name for WCDMA stations
     radio_type = {"UMTS": "wcdma", "GSM": "gsm", "LTE": "lte", "": "Unknown"}
-
-    counts = defaultdict(Counter)
-    areas = set()
-    areas_total = 0
-    total = 0
-
-    if not csv_content:
-        LOGGER.warning("Nothing to process.")
-        return
-
-    first_row = csv_content.peek()
-    if first_row == _FIELD_NAMES:
-        # Skip the first row because it's a header row
-        next(csv_content)
-    else:
-        LOGGER.warning("Expected header row, got data: %s", first_row)
+    valid = 0
 
     for row in csv_content:
         try:
@@ -170,7 +148,7 @@ def read_stations_from_csv(session, file_handle, redis_client, cellarea_queue):
             }
             shard = CellShard.create(_raise_invalid=True, **data)
         except (colander.Invalid, ValueError) as e:
-            if total == 0:
+            if valid == 0:
                 # If the first row is invalid, it's likely the rest of the
                 # file is, too--drop out here.
                 raise InvalidCSV("first row %s is invalid: %s" % (row, e))
@@ -178,58 +156,113 @@ def read_stations_from_csv(session, file_handle, redis_client, cellarea_queue):
                 LOGGER.warning("row %s is invalid: %s", row, e)
                 continue
 
-        # Is this station in the database?
-        shard_type = shard.__class__
-        existing = (
+        valid += 1
+        yield data, shard
+
+
+def _query_existing_stations(session, stations):
+    """
+    Return a dict of cellid to existing database station, using one
+    query per shard table.
+    """
+    cellids = defaultdict(list)
+    for _, shard in stations:
+        cellids[shard.__class__].append(shard.cellid)
+
+    existing = {}
+    for shard_type, keys in cellids.items():
+        rows = (
             session.query(shard_type)
-            .filter(shard_type.cellid == shard.cellid)
+            .filter(shard_type.cellid.in_(keys))
             .options(load_only("modified"))
-            .one_or_none()
+            .all()
         )
+        for row in rows:
+            existing[row.cellid] = row
+    return existing
+
 
-        if existing:
-            if existing.modified < data["modified"]:
-                # Update existing station with new data
-                operation = "updated"
-                existing.psc = shard.psc
-                existing.lon = shard.lon
-                existing.lat = shard.lat
-                existing.radius = shard.radius
-                existing.samples = shard.samples
-                existing.created = shard.created
-                existing.modified = shard.modified
+def read_stations_from_csv(session, file_handle, redis_client, cellarea_queue):
+    """
+    Read stations from a public cell export CSV.
+
+    :arg session: a database session
+    :arg file_handle: an open file handle for the CSV data
+    :arg redis_client: a Redis client
+    :arg cellarea_queue: the DataQueue for updating cellarea IDs
+    """
+    # Avoid circular imports
+    from ichnaea.data.tasks import update_cellarea, update_statregion
+
+    csv_content = peekable(reader(file_handle))
+
+    counts = defaultdict(Counter)
+    areas = set()
+    areas_total = 0
+    total = 0
+
+    if not csv_content:
+        LOGGER.warning("Nothing to process.")
+        return
+
+    first_row = csv_content.peek()
+    if first_row == _FIELD_NAMES:
+        # Skip the first row because it's a header row
+        next(csv_content)
+    else:
+        LOGGER.warning("Expected header row, got data: %s", first_row)
+
+    for stations in chunked(_parse_station_rows(csv_content), 1000):
+        # Look up the existing stations of the whole chunk at once
+        existing_stations = _query_existing_stations(session, stations)
+
+        for data, shard in stations:
+            existing = existing_stations.get(shard.cellid)
+            if existing:
+                if existing.modified < data["modified"]:
+                    # Update existing station with new data
+                    operation = "updated"
+                    existing.psc = shard.psc
+                    existing.lon = shard.lon
+                    existing.lat = shard.lat
+                    existing.radius = shard.radius
+                    existing.samples = shard.samples
+                    existing.created = shard.created
+                    existing.modified = shard.modified
+                else:
+                    # Do nothing to existing station record
+                    operation = "found"
             else:
-                # Do nothing to existing station record
-                operation = "found"
-        else:
-            # Add a new station record
-            operation = "new"
-            shard.min_lat = shard.lat
-            shard.max_lat = shard.lat
-            shard.min_lon = shard.lon
-            shard.max_lon = shard.lon
-            session.add(shard)
-
-        counts[data["radio"]][operation] += 1
-
-        # Process the cell area?
-        if operation in {"new", "updated"}:
-            areas.add(area_id(shard))
-
-        # Process a chunk of stations, report on progress
-        total += 1
-        if total % 1000 == 0:
-            session.commit()
-            LOGGER.info("Processed %d stations", total)
-
-        if areas and (len(areas) % 1000 == 0):
-            session.commit()
-            areas_total += len(areas)
+                # Add a new station record
+                operation = "new"
+                shard.min_lat = shard.lat
+                shard.max_lat = shard.lat
+                shard.min_lon = shard.lon
+                shard.max_lon = shard.lon
+                session.add(shard)
+                existing_stations[shard.cellid] = shard
+
+            counts[data["radio"]][operation] += 1
+
+            # Process the cell area?
+            if operation in {"new", "updated"}:
+                areas.add(area_id(shard))
+
+            total += 1
+
+        # Commit only between chunks, as committing expires the
+        # existing stations looked up for the chunk
+        session.commit()
+        LOGGER.info("Processed %d stations", total)
+
+        # Process the cell areas in batches of 1000
+        while len(areas) >= 1000:
+            area_batch = [areas.pop() for _ in range(1000)]
+            areas_total += len(area_batch)
             LOGGER.info("Processed %d station areas", areas_total)
             with redis_pipeline(redis_client) as pipe:
-                cellarea_queue.enqueue(list(areas), pipe=pipe)
+                cellarea_queue.enqueue(area_batch, pipe=pipe)
             update_cellarea.delay()
-            areas = set()
 
     # Commit remaining station data
     session.commit()
@@ -3,10 +3,11 @@ import time
 from unittest import mock
 
 import boto3
+from everett.manager import config_override
 import pytest
 import requests_mock
 
-from ichnaea.data.export import DummyExporter, InternalTransform
+from ichnaea.data.export import DummyExporter, InternalExporter, InternalTransform
 from ichnaea.data.tasks import update_blue, update_cell, update_incoming, update_wifi
 from ichnaea.models import BlueShard, CellShard, WifiShard
 from ichnaea.tests.factories import (
@@ -633,6 +634,37 @@ class TestInternal(BaseExportTest):
         assert wifi.mac == wifi_data["macAddress"]
         assert wifi.samples == 1
 
+    def test_retry(self, celery, session):
+        reports = self.add_reports(celery, cell_factor=0, wifi_factor=1)
+
+        num = [0]
+        orig_queue_observations = InternalExporter.queue_observations
+        orig_wait = InternalExporter._retry_wait
+
+        def mock_queue_observations(self, pipe, queued_obs, num=num):
+            num[0] += 1
+            if num[0] == 1:
+                raise IOError()
+            return orig_queue_observations(self, pipe, queued_obs)
+
+        with mock.patch(
+            "ichnaea.data.export.InternalExporter.queue_observations",
+            mock_queue_observations,
+        ):
+            try:
+                InternalExporter._retry_wait = 0.001
+                self._update_all(session)
+            finally:
+                InternalExporter._retry_wait = orig_wait
+
+        # The retried send still sees the original report
+        assert num[0] == 2
+        wifi_data = reports[0]["wifiAccessPoints"][0]
+        shard = WifiShard.shard_model(wifi_data["macAddress"])
+        wifis = session.query(shard).all()
+        assert len(wifis) == 1
+        assert wifis[0].mac == wifi_data["macAddress"]
+
     def test_wifi_duplicated(self, celery, session):
         self.add_reports(celery, cell_factor=0, wifi_factor=1)
         # duplicate the wifi entry inside the report
@@ -686,6 +718,7 @@ class TestInternal(BaseExportTest):
         self.add_reports(celery, 1, cell_factor=0, wifi_factor=0)
         self._update_all(session)
 
+    @config_override(MAPBOX_TOKEN="pk.123456")
     def test_datamap(self, celery, session):
         self.add_reports(celery, 1, cell_factor=0, wifi_factor=2, lat=50.0, lon=10.0)
         self.add_reports(celery, 2, cell_factor=0, wifi_factor=2, lat=20.0, lon=-10.0)
@@ -693,6 +726,12 @@ class TestInternal(BaseExportTest):
         assert celery.data_queues["update_datamap_ne"].size() == 1
         assert celery.data_queues["update_datamap_sw"].size() == 1
 
+    @config_override(MAPBOX_TOKEN="")
+    def test_datamap_disabled(self, celery, session):
+        self.add_reports(celery, 1, cell_factor=0, wifi_factor=2, lat=50.0, lon=10.0)
+        self._update_all(session, datamap_only=True)
+        assert celery.data_queues["update_datamap_ne"].size() == 0
+
     def test_no_position(self, celery, session, metricsmock):
         self.add_reports(celery, 1, set_position=False)
         self._update_all(session)
@@ -322,6 +322,72 @@ UMTS,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220564,1570120316,
         assert session.query(func.count(CellArea.areaid)).scalar() == 0
         assert session.query(func.count(RegionStat.region)).scalar() == 0
 
+    def test_multiple_chunks(self, session, redis_client, cellarea_queue):
+        """Imports over 1000 rows are processed in chunks."""
+        station_data = {
+            "radio": Radio.gsm,
+            "mcc": 208,
+            "mnc": 10,
+            "lac": 1201,
+            "cid": 1201,
+            "lat": 46.5,
+            "lon": 2.5,
+            "radius": 1,
+            "samples": 1,
+            "created": datetime(2019, 1, 1, tzinfo=UTC),
+            "modified": datetime(2019, 1, 1, tzinfo=UTC),
+        }
+        station = CellShard.create(_raise_invalid=True, **station_data)
+        session.add(station)
+        session.flush()
+
+        # Each row is a station in its own cell area
+        rows = [
+            "GSM,208,10,%d,%d,,2.5112670,46.5992450,0,78,1,1566307030,1570119413,"
+            % (i, i)
+            for i in range(1, 1501)
+        ]
+        header = (
+            "radio,mcc,net,area,cell,unit,lon,lat,range,samples,changeable,"
+            "created,updated,averageSignal"
+        )
+        csv = StringIO("\n".join([header] + rows) + "\n")
+        with mock.patch.object(
+            cellarea_queue, "enqueue", wraps=cellarea_queue.enqueue
+        ) as enqueue:
+            read_stations_from_csv(session, csv, redis_client, cellarea_queue)
+
+        # The cell areas are queued in batches of 1000
+        assert [len(call[0][0]) for call in enqueue.call_args_list] == [1000, 500]
+
+        gsm_model = CellShard.shard_model(Radio.gsm)
+        assert session.query(func.count(gsm_model.cellid)).scalar() == 1500
+        assert session.query(func.count(CellArea.areaid)).scalar() == 1500
+
+        # The existing station in the second chunk is updated
+        updated = session.query(gsm_model).filter(gsm_model.lac == 1201).one()
+        assert updated.lat == 46.5992450
+        assert updated.lon == 2.5112670
+        assert updated.samples == 78
+
+    def test_duplicate_station(self, session, redis_client, cellarea_queue):
+        """A station repeated in the same CSV is only inserted once."""
+        csv = StringIO(
+            """\
+radio,mcc,net,area,cell,unit,lon,lat,range,samples,changeable,created,updated,averageSignal
+UMTS,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220564,1570120316,
+UMTS,202,1,2120,12842,,23.4123168,38.8574352,0,7,1,1568220564,1570120317,
+"""
+        )
+        read_stations_from_csv(session, csv, redis_client, cellarea_queue)
+
+        # The newer second row updates the station added by the first row
+        wcdma = session.query(CellShard.shard_model(Radio.wcdma)).one()
+        assert wcdma.lat == 38.8574352
+        assert wcdma.lon == 23.4123168
+        assert wcdma.samples == 7
+        assert wcdma.modified == datetime(2019, 10, 3, 16, 31, 57, tzinfo=UTC)
+
     def test_unexpected_radio_halts(self, session, redis_client, cellarea_queue):
         """
         A row with an unexpected radio type halts processing of the CSV.
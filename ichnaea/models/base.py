@@ -31,11 +31,9 @@ class HashableDict(object):
     _fields = ()
 
     def __init__(self, **kw):
-        for field in self._fields:
-            if field in kw:
-                setattr(self, field, kw[field])
-            else:
-                setattr(self, field, None)
+        # set all fields in one update, defaulting missing ones to None
+        get = kw.get
+        self.__dict__.update({field: get(field) for field in self._fields})
 
     def __eq__(self, other):
         if isinstance(other, HashableDict):
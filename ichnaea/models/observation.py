@@ -54,14 +54,13 @@ class BaseObservation(object):
 
     def _to_json_value(self):
         # create a sparse representation of this instance
-        dct = {}
-        for field in self._fields:
-            value = getattr(self, field, None)
-            if value is not None:
-                if field == "source" and type(value) == ReportSource:
-                    dct[field] = int(value)
-                else:
-                    dct[field] = value
+        get = self.__dict__.get
+        dct = {
+            field: value for field in self._fields if (value := get(field)) is not None
+        }
+        source = dct.get("source")
+        if type(source) == ReportSource:
+            dct["source"] = int(source)
         return dct
 
     def to_json(self):
@@ -368,11 +367,11 @@ class CellReport(BaseReport):
 
     @property
     def shard_id(self):
-        return CellShard.shard_id(self.cellid)
+        return CellShard.shard_id(self.radio)
 
     @property
     def shard_model(self):
-        return CellShard.shard_model(self.cellid)
+        return CellShard.shard_model(self.radio)
 
     @property
     def cellid(self):
@@ -1,5 +1,4 @@
 from datetime import datetime
-from zoneinfo import ZoneInfo
 import time
 
 from enum import IntEnum
@@ -7,6 +6,8 @@ from sqlalchemy import String
 from sqlalchemy.dialects.mysql import DATETIME as DateTime, TINYINT as TinyInteger
 from sqlalchemy.types import TypeDecorator
 
+from ichnaea.util import UTC
+
 
 class SetColumn(TypeDecorator):
     """
@@ -69,5 +70,5 @@ class TZDateTime(TypeDecorator):
     def process_result_value(self, value, dialect):
         if value is not None:
             ts = time.mktime(value.timetuple())
-            value = datetime.fromtimestamp(ts).replace(tzinfo=ZoneInfo("UTC"))
+            value = datetime.fromtimestamp(ts).replace(tzinfo=UTC)
         return value
@@ -50,7 +50,8 @@ class DataQueue(object):
             if self.compress:
                 result = [util.decode_gzip(item) for item in result]
             if self.json:
-                result = [json.loads(item.decode("utf-8")) for item in result]
+                # json.loads accepts UTF-8 encoded bytes
+                result = [json.loads(item) for item in result]
 
         return result
 
@@ -68,6 +69,10 @@ class DataQueue(object):
         The items will be pushed into Redis as part of a single (given)
         pipe in batches corresponding to the given batch argument.
         """
+        if not items:
+            # nothing to push, avoid an empty command
+            return
+
         if batch is None:
             batch = self.batch
 
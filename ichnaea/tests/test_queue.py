@@ -42,6 +42,12 @@ class TestDataQueue(object):
         assert second == [4, 5]
         assert queue.dequeue() == [6]
 
+    def test_empty(self, redis):
+        queue = self._make_queue(redis)
+        queue.enqueue([])
+        assert queue.size() == 0
+        assert redis.ttl(queue.key) < 0
+
     def test_pipe(self, redis):
         queue = self._make_queue(redis)
         pipe = redis.pipeline()